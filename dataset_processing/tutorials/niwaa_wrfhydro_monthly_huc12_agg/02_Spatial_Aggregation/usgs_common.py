@@ -10,8 +10,12 @@
 
 import os
 import sys
+import json
 import pathlib
+import resource
 import time
+import datetime
+from contextlib import contextmanager
 from pathlib import Path
 
 import xarray as xr
@@ -104,6 +108,17 @@ soil_depths_mm = [100, 300, 600, 1000]
 
 # --- End Other settings --- #
 
+# --- Performance instrumentation settings --- #
+
+# Pipelines that may be recorded in a run log. Used to label records so that
+# a slowdown can be attributed to one part of the monthly production run.
+perf_pipelines = ['LDASOUT', 'RTOUT', '1D']
+
+# Summary columns reported when comparing runs from a run log
+perf_report_columns = ['seconds', 'input_file_bytes', 'bytes_read', 'input_nbytes', 'bytes_written', 'peak_rss_increase_gb', 'worker_peak_rss_increase_gb', 'dask_tasks']
+
+# --- End Performance instrumentation settings --- #
+
 # --- Functions --- #
 
 def get_size_gb(input_da, silent=False):
@@ -199,23 +214,38 @@ def run_flox_old(data, flox_by, flox_method='cohorts', flox_function="mean", n=1
     print('\t[{0}] Flox groupby method ({1}): {2} records in {3:3.2f} seconds.'.format(n, flox_function, output[0].shape[0], time.time()-tic1))
     return output
 
-def run_flox(data, flox_by, flox_function="mean", n=1):
-    tic1 = time.time()
-    #output = flox.xarray.xarray_reduce(data, flox_by, func=flox_function)
-    output = flox.xarray.xarray_reduce(data, flox_by, func=flox_function).compute()
-    print('\t[{0}]    Calculated zonal {1} in {2:3.2f} seconds.'.format(n, flox_function, time.time()-tic1))
+def run_flox(data, flox_by, flox_function="mean", n=1, run_log=None):
+    '''
+    Calculate a zonal statistic using flox and compute the result. If a run log
+    is provided, the reduction is recorded as a 'reduce' stage, including the
+    memory used by the Dask workers if a distributed client is active.
+    '''
+    # Count the Dask graph before timing, as this is expensive for large graphs
+    graph_info = {}
+    if run_log is not None:
+        graph_info = {'dask_tasks': dask_task_count(data), 'chunks': chunk_sizes(data)}
+    with perf_span(run_log, 'reduce', worker_memory=True, variable=data.name, function=flox_function, n=n, **graph_info) as span:
+        span['input_nbytes'] = data.nbytes
+        #output = flox.xarray.xarray_reduce(data, flox_by, func=flox_function)
+        output = flox.xarray.xarray_reduce(data, flox_by, func=flox_function).compute()
+    print('\t[{0}]    Calculated zonal {1} in {2:3.2f} seconds.'.format(n, flox_function, span['seconds']))
     #print('\t[{0}] Flox groupby method ({1}): {2} records in {3:3.2f} seconds.'.format(n, flox_function, output[0].shape[0], time.time()-tic1))
     #return output.compute()
     return output
 
-def write_csv(data_out, out_file, columns=[], index=None, drops=None):
+def write_csv(data_out, out_file, columns=[], index=None, drops=None, run_log=None):
+    '''
+    Write an xarray object to a CSV file. If a run log is provided, the export
+    is recorded as a 'write' stage.
+    '''
     # Write output file
-    tic1 = time.time()
-    df_out = data_out.to_dataframe()
-    if drops is not None:
-        df_out = df_out.drop(columns=drops)
-    df_out.to_csv(out_file)
-    print('\t      Output file written in {0:3.2f} seconds.'.format(time.time()-tic1))
+    with perf_span(run_log, 'write', out_file=str(out_file), format='csv') as span:
+        df_out = data_out.to_dataframe()
+        if drops is not None:
+            df_out = df_out.drop(columns=drops)
+        df_out.to_csv(out_file)
+        span['bytes_written'] = os.path.getsize(out_file)
+    print('\t      Output file written in {0:3.2f} seconds.'.format(span['seconds']))
 
 # Function to list files in a directory
 def get_files_wildcard(inDir, file_pattern='*', recursive=False, silent=False):
@@ -229,12 +259,13 @@ def get_files_wildcard(inDir, file_pattern='*', recursive=False, silent=False):
     return file_in
 
 # Function to describe the structure of the input file
-def report_structure(ds, variable, time_coord=time_coord, silent=False, xy_chunks=True):
+def report_structure(ds, variable, time_coord=time_coord, silent=False, xy_chunks=True, run_log=None):
     '''
     Inputs:
         ds - an xarray DataSet object.
         variable - String - a variable in the input DataSet object to examine.
         time_coord - string - the name of the time coordinate in the input DataSet object.
+        run_log - dictionary - optional run log (see new_run_log) to record the sizing information in.
     Outputs:
         ds - The xarray DataSet object, possibly altered to unify chunk sizes
         timesteps - The time values in the input ifle
@@ -283,6 +314,18 @@ def report_structure(ds, variable, time_coord=time_coord, silent=False, xy_chunk
         print('Size of 1 chunk, ({0},{1}) cells, of the dataset:  {2:3.3f} Gb'.format(x_chunk_sizes[0], y_chunk_sizes[0], full_chunk_ds_size_GB)) 
         print('X chunk sizes [first, last]: {0}, {1}'.format(x_chunk_sizes[0], x_chunk_sizes[-1]))
         print('Y chunk sizes [first, last]: {0}, {1}'.format(y_chunk_sizes[0], y_chunk_sizes[-1]))       
+
+    # Record the sizing information in the run log
+    if run_log is not None:
+        log_record(run_log, 'structure',
+                   variable=variable,
+                   timesteps=int(timesteps.shape[0]),
+                   dataset_size_gb=dataset_size_GB,
+                   timestep_size_gb=timestep_size_GB,
+                   time_chunk_size_gb=full_time_chunk_ds_size_GB,
+                   chunk_size_gb=full_chunk_ds_size_GB,
+                   dask_tasks=dask_task_count(ds[variable]),
+                   chunks=chunk_sizes(ds[variable]))
     return ds, timesteps, x_chunk_sizes, y_chunk_sizes, time_chunk_sizes
     
 # This function is used if the input files end in a YYYMM datestring.
@@ -460,6 +503,224 @@ def soil_water_pct_sat(da_ldasout, file_soil_param, soil_depths=[100, 300, 600,
     ds_soil_param.close()
     return result
 
+# --- Performance instrumentation --- #
+
+def new_run_log(log_file, pipeline, run_id=None):
+    '''
+    Create a run log that timing spans and sizing records will be appended to.
+    The run log is a JSON lines file, one record per line, so that several runs
+    (and several pipelines) can share one file and be compared later.
+
+        log_file - Path to the JSONL run log. Created if it does not exist.
+        pipeline - Name of the pipeline being run (LDASOUT, RTOUT or 1D).
+        run_id   - Identifier for this run. Defaults to the current local time.
+    '''
+    if pipeline not in perf_pipelines:
+        raise ValueError('Pipeline name \'{0}\' is not one of {1}.'.format(pipeline, perf_pipelines))
+    if run_id is None:
+        run_id = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+    return {'log_file': str(log_file), 'pipeline': pipeline, 'run_id': run_id}
+
+def peak_rss_gb():
+    '''
+    Return the peak resident set size of this process in Gb, since the process
+    started. This can only increase, so it is not a measure of one stage alone.
+    Note that this does not include memory used by Dask workers in other processes.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak/(1024.**3)              # Reported in bytes on macOS
+    return peak/(1024.**2)                  # Reported in kilobytes on Linux
+
+def worker_peak_rss_gb():
+    '''
+    Return the peak resident set size in Gb of each Dask worker, keyed by worker
+    address, or None if there is no active distributed client. Like peak_rss_gb,
+    this is the peak since each worker process started.
+    '''
+    try:
+        from distributed import default_client
+        client = default_client()
+    except (ImportError, ValueError):
+        return None
+
+    # Defined here so that it is sent to the workers by value, as the workers
+    # may not be able to import this module
+    def _peak_rss_gb():
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return peak/(1024.**3)
+        return peak/(1024.**2)
+    return client.run(_peak_rss_gb)
+
+def dask_task_count(obj):
+    '''
+    Return the number of tasks in the Dask graph behind an Xarray DataSet or
+    DataArray, or 0 if the object is not backed by Dask.
+    '''
+    graph = obj.__dask_graph__()
+    if graph is None:
+        return 0
+    return len(graph)
+
+def chunk_sizes(obj):
+    '''
+    Return the size of the first chunk in each dimension of an Xarray DataSet
+    or DataArray, or an empty dictionary if the object is not chunked.
+    '''
+    if obj.chunks is None:
+        return {}
+    return {dim: int(sizes[0]) for dim, sizes in obj.chunksizes.items()}
+
+def log_record(run_log, stage, **fields):
+    '''
+    Append one record to the run log. Does nothing if run_log is None, so that
+    functions may be called with or without instrumentation.
+    '''
+    if run_log is None:
+        return
+    record = {'run_id': run_log['run_id'],
+              'pipeline': run_log['pipeline'],
+              'stage': stage,
+              'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+              'process_peak_rss_gb': peak_rss_gb()}
+    record.update(fields)
+    with open(run_log['log_file'], 'a') as log:
+        log.write(json.dumps(record, default=str) + '\n')
+
+@contextmanager
+def perf_span(run_log, stage, worker_memory=False, **fields):
+    '''
+    Context manager to time one stage (read, zone_build, reduce, write) of the
+    pipeline and append it to the run log. Yields a dictionary that the caller
+    may add fields to, such as bytes_read or bytes_written. Note that opening
+    files with Xarray is lazy, so the read stage only measures the open, and the
+    data is read from disk during the reduce stage. The reduce stage records the
+    in-memory size of the array it reduces as input_nbytes. The elapsed time is
+    available as span['seconds'] once the block exits. The amount by which the
+    stage raised the peak memory of the process is recorded as peak_rss_increase_gb,
+    which is 0 if an earlier stage already used more memory. If worker_memory is
+    True and a distributed client is active, the same is recorded for the Dask
+    workers as worker_peak_rss_increase_gb (the largest increase of any worker),
+    along with worker_peak_rss_gb and the number of workers. The workers are
+    sampled outside of the timed block. If the block raises an exception, the
+    stage is recorded with status 'error' and the exception type.
+
+        with perf_span(run_log, 'write', out_file=out_file) as span:
+            ds.to_netcdf(out_file)
+            span['bytes_written'] = os.path.getsize(out_file)
+    '''
+    span = dict(fields)
+    worker_rss_start = None
+    if run_log is not None and worker_memory:
+        worker_rss_start = worker_peak_rss_gb()
+    tic1 = time.time()
+    peak_rss_start = peak_rss_gb()
+    try:
+        yield span
+        span['status'] = 'ok'
+    except BaseException as err:
+        span['status'] = 'error'
+        span['error'] = type(err).__name__
+        raise
+    finally:
+        span['seconds'] = time.time()-tic1
+        span['peak_rss_increase_gb'] = peak_rss_gb()-peak_rss_start
+        if worker_rss_start is not None:
+            # Workers started during the stage (e.g. by an adaptive cluster) begin at 0
+            worker_rss_end = worker_peak_rss_gb()
+            if worker_rss_end:
+                span['workers'] = len(worker_rss_end)
+                span['worker_peak_rss_gb'] = max(worker_rss_end.values())
+                span['worker_peak_rss_increase_gb'] = max(
+                    rss - worker_rss_start.get(worker, 0.) for worker, rss in worker_rss_end.items())
+        log_record(run_log, stage, **span)
+
+def read_run_log(log_file):
+    '''
+    Read a run log into a pandas DataFrame. Accepts the JSONL run log or a
+    Parquet copy of it (written with read_run_log(log_file).to_parquet(...)).
+    '''
+    if Path(log_file).suffix == '.parquet':
+        return pd.read_parquet(log_file)
+    return pd.read_json(log_file, lines=True, dtype={'run_id': str})
+
+def compare_runs(log_file, pipeline=None, run_ids=None, baseline=None, silent=False):
+    '''
+    Summarize each stage of each pipeline by run, to find which stage regressed
+    between runs. Times, bytes and increases in the peak memory of the process
+    are summed over a stage. Stages that raised an error are left out of the
+    summary, and are counted separately.
+
+        log_file - Path to the run log.
+        pipeline - Only compare runs of this pipeline (LDASOUT, RTOUT or 1D).
+        run_ids  - List of runs to compare. Defaults to all runs in the log.
+        baseline - Run to compare the others to. Defaults to the first run.
+    Outputs:
+        report - DataFrame indexed by (pipeline, stage) with one column per
+                 statistic and run, plus the ratio of seconds to the baseline.
+                 None if there are no completed stages to compare.
+    '''
+    df = read_run_log(log_file)
+    if 'stage' not in df.columns:
+        if not silent:
+            print('No records found in run log {0}.'.format(log_file))
+        return None
+    df = df[df['stage'] != 'structure']
+    if pipeline is not None:
+        df = df[df['pipeline'] == pipeline]
+    if run_ids is not None:
+        df = df[df['run_id'].isin(run_ids)]
+
+    # Leave out stages that did not complete, which would otherwise appear to be fast
+    if 'status' in df.columns:
+        failed = df[df['status'] == 'error']
+        if not silent and failed.shape[0] > 0:
+            print('Excluding {0} stage(s) that raised an error:'.format(failed.shape[0]))
+            print(failed.groupby(['pipeline', 'stage', 'run_id', 'error']).size().to_string())
+        df = df[df['status'] != 'error']
+
+    # Check that there is something to compare
+    if df.shape[0] == 0:
+        if not silent:
+            print('No completed stages found in run log {0} (pipeline={1}, run_ids={2}).'.format(log_file, pipeline, run_ids))
+        return None
+    found_run_ids = list(df['run_id'].unique())
+    if run_ids is None:
+        run_ids = found_run_ids
+    else:
+        missing = [run_id for run_id in run_ids if run_id not in found_run_ids]
+        if not silent and len(missing) > 0:
+            print('    Run(s) {0} have no completed stages in the run log and will not be compared.'.format(missing))
+        run_ids = [run_id for run_id in run_ids if run_id in found_run_ids]
+    if baseline is None:
+        baseline = run_ids[0]
+    elif baseline not in run_ids:
+        if not silent:
+            print('Baseline run {0} has no completed stages among the runs compared: {1}'.format(baseline, run_ids))
+        return None
+
+    columns = [column for column in perf_report_columns if column in df.columns]
+    aggs = {column: 'sum' for column in columns}
+    report = (
+        df.groupby(['pipeline', 'stage', 'run_id'])
+        .agg(aggs)
+        .unstack('run_id')
+        .reindex(columns=run_ids, level='run_id'))
+
+    # Ratio of time taken relative to the baseline run
+    for run_id in run_ids:
+        report[('seconds_ratio', run_id)] = report[('seconds', run_id)] / report[('seconds', baseline)]
+    if not silent:
+        print('Comparing {0} run(s) against baseline run {1}:'.format(len(run_ids), baseline))
+        print(report[['seconds', 'seconds_ratio']].round(2).to_string())
+    return report
+
+# --- End Performance instrumentation --- #
+
 # --- End Functions --- #
 
 if __name__ == '__main__':